@@ -15,15 +15,22 @@ TODO:
 '''
 
 from agno.agent import Agent
-from agno.team import Team
 from agno.os import AgentOS
+from agno.session.summary import SessionSummaryManager
+from agno.utils.log import log_warning
 
 # Model
-from agno.models.anthropic import Claude
 from agno.models.xai import xAI
 
 # PostgreSQL Database (Supabase)
+from agno.db.base import SessionType
 from agno.db.postgres import PostgresDb
+from sqlalchemy import create_engine
+
+try:
+    from agno.db.utils import json_serializer
+except ImportError:  # older agno releases use SQLAlchemy's default serializer
+    json_serializer = None
 
 # RAG Chromadb Database
 # import chromadb
@@ -35,35 +42,77 @@ from agno.db.postgres import PostgresDb
 
 
 # Tools
-from agno.tools.duckduckgo import DuckDuckGoTools
 from agno.tools.mcp import MultiMCPTools
+from mcp import StdioServerParameters
 
 # async run for MCP
 import asyncio
+import gc
+
+# shared HTTP client for model calls
+import httpx
+from contextlib import asynccontextmanager
 
-# tracing and evaluation
-from phoenix.otel import register
+# tool result cache
+import hashlib
+import orjson
+import re
+import shutil
+import time
+from functools import lru_cache
 
 # Load environment variables
 import os
 import dotenv
 dotenv.load_dotenv()
 
+# Settings, read and checked once at import - a missing credential stops the app at boot
+# instead of surfacing as failed model or tool calls
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+XAI_API_KEY = os.getenv("XAI_API_KEY")
+APP_ID = os.getenv("APP_ID")
+APP_SECRET = os.getenv("APP_SECRET")
+CORS_ALLOWED_ORIGINS = os.getenv("CORS_ALLOWED_ORIGINS", "https://os.agno.com,http://localhost:3000").split(",")
+
+_required = {"SUPABASE_DB_URL": SUPABASE_DB_URL, "XAI_API_KEY": XAI_API_KEY, "APP_ID": APP_ID, "APP_SECRET": APP_SECRET}
+_missing = [name for name, value in _required.items() if not value]
+if _missing:
+    raise RuntimeError(f"Missing env vars: {', '.join(_missing)}")
+
 # Declare database
 
-db = PostgresDb(
-    db_url=os.getenv("SUPABASE_DB_URL"),
-    # Table to store your Agent, Team and Workflow sessions and runs
-    session_table="sessions",
-    # Table to store all user memories
-    memory_table="memory",
-    # Table to store all metrics aggregations
-    metrics_table="metrics",
-    # Table to store all your evaluation data
-    eval_table="evals",
-    # Table to store all your knowledge content
-    knowledge_table="knowledge",
-)
+@lru_cache(maxsize=1)
+def _get_db():
+    """Build the database and its connection pool once, however many agents ask for it"""
+    # Explicit connection pool so concurrent session reads and writes don't queue on one connection
+    db_engine = create_engine(
+        SUPABASE_DB_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        pool_use_lifo=True,
+        json_serializer=json_serializer,
+    )
+
+    return PostgresDb(
+        db_engine=db_engine,
+        # Table to store your Agent, Team and Workflow sessions and runs
+        session_table="sessions",
+        # Table to store all user memories
+        memory_table="memory",
+        # Table to store all metrics aggregations
+        metrics_table="metrics",
+        # Table to store all your evaluation data
+        eval_table="evals",
+        # Table to store all your knowledge content
+        knowledge_table="knowledge",
+    )
+
+
+db = _get_db()
 
 # Configure RAG database with Chroma
 
@@ -107,6 +156,11 @@ Members:
 """
 # def content_team():
 #     """Run AI Agent team."""
+#     # Only this team needs these - imported here so the Lark app boots without them
+#     from agno.team import Team
+#     from agno.models.anthropic import Claude
+#     from agno.tools.duckduckgo import DuckDuckGoTools
+#
 #     ## Declare MCP tools - Only Freepik (Mapbox removed due to timeout)
 #     content_env = {
 #             **os.environ,
@@ -125,10 +179,7 @@ Members:
 #     outline_agent = Agent(
 #         name = "Outline Agent",
 #         role = "Create a short story outline based on a given topic",
-#         model = xAI(
-#         id="grok-4-0709",
-#         api_key=os.getenv("XAI_API_KEY"),
-#         ),
+#         model = _XAI,
 #         description="You are short story idea creator. You generate an idea and suggest a clear outline base on a given topic",
 #         instructions = [
 #             "When asked to write a story, only return the story and nothing else.",
@@ -152,10 +203,7 @@ Members:
 #     content_writer = Agent(
 #         name = "Content Writer Agent",
 #         role = "Write story based on a given outline",
-#         model = xAI(
-#         id="grok-4-0709",
-#         api_key=os.getenv("XAI_API_KEY"),
-#         ),
+#         model = _XAI,
 #         description="You are a short storywriter. Base on a given outline, you write a short compelling story.",
 #         instructions=[
 #             "Story must be under 500 words."
@@ -181,10 +229,7 @@ Members:
 #     image_integrator = Agent(
 #         name = "Image Integration Agent",
 #         role = "Insert relevant images into stories using Freepik",
-#         model = xAI(
-#         id="grok-4-0709",
-#         api_key=os.getenv("XAI_API_KEY"),
-#         ),
+#         model = _XAI,
 #         description="You are an image integration specialist. You analyze stories, identify key moments that need visual illustration, search for authentic real images using Freepik, and embed them into the story using markdown image syntax. You ONLY use real photography, never AI-generated images.",
 #         instructions=[
 #             "Analyze the story and identify 2-3 key moments or scenes that would benefit from images.",
@@ -239,10 +284,7 @@ Members:
 #     content_team = Team(
 #         name="AI SEO Content Team",
 #         role="Coordinate the team members to create a short story with images. Every story MUST include images.",
-#         model = xAI(
-#         id="grok-4-0709",
-#         api_key=os.getenv("XAI_API_KEY"),
-#         ),
+#         model = _XAI,
 #         description="You coordinate a team to create illustrated short stories. Every story must have images embedded.",
 #         instructions=[
 #             "Step 1: Use outline agent to generate a story outline",
@@ -285,64 +327,180 @@ Members:
 #     return agent_os
 
 
+"""
+TOOL RESULT CACHE
+
+Read-style Lark MCP calls are served from memory for a short while - lookups by id for
+5 minutes, lists and searches for 30 seconds. Any other tool call may have written to the
+base and clears the cache. Same key and policy as the webhook bot in main.py; only this app
+counts hits and misses, for its /tool-cache/metrics route.
+"""
+READ_TOOL_RE = re.compile(r"(list|search|get|query)$", re.IGNORECASE)
+GET_TOOL_RE = re.compile(r"get$", re.IGNORECASE)
+TOOL_CACHE_TTL = 30  # seconds, list/search/query
+TOOL_CACHE_GET_TTL = 300  # seconds, get by id
+TOOL_CACHE_MAX_ENTRIES = 4096
+tool_cache = {}  # sha256(tool name, args) -> (expires_at, result)
+tool_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+async def cache_tool_results(function_name, function_call, arguments):
+    """Tool hook serving repeated read-only MCP calls from tool_cache"""
+    if not READ_TOOL_RE.search(function_name):
+        if tool_cache:
+            tool_cache.clear()
+            tool_cache_stats["invalidations"] += 1
+        return await function_call(**arguments)
+
+    key = hashlib.sha256(
+        function_name.encode() + b"|" + orjson.dumps(arguments, default=str, option=orjson.OPT_SORT_KEYS)
+    ).digest()
+    entry = tool_cache.get(key)
+    if entry is not None and entry[0] > time.time():
+        tool_cache_stats["hits"] += 1
+        tool_cache[key] = tool_cache.pop(key)  # most recently used goes last
+        return entry[1]
+
+    tool_cache_stats["misses"] += 1
+    result = await function_call(**arguments)
+    if len(tool_cache) >= TOOL_CACHE_MAX_ENTRIES:
+        del tool_cache[next(iter(tool_cache))]
+    ttl = TOOL_CACHE_GET_TTL if GET_TOOL_RE.search(function_name) else TOOL_CACHE_TTL
+    tool_cache[key] = (time.time() + ttl, result)
+    return result
+
+
 """
 LARK TASK AGENT
 """
+# Agent prompt, built once - passed as description/instructions rather than a pre-rendered
+# system_message so Agno still appends the session summary and markdown guidance
+LARK_AGENT_DESCRIPTION = "You are a task management assistant that helps users manage their tasks in Lark Base using Lark MCP. You can create, update, delete, and retrieve tasks based on user requests."
+LARK_AGENT_INSTRUCTIONS = [
+    "Use the Lark MCP tool to interact with Lark Base. The specific base id is 'Q9gVbS1j1anjh7sP56Dln1xFgdG'.",
+    "When creating or updating tasks, ensure to include all necessary fields such as title, description, due date, and status.",
+    "Always confirm actions with the user before making changes to their tasks.",
+    "Provide clear and concise responses to the user regarding their task management requests."
+]
+SESSION_SUMMARY_PROMPT = """\
+Summarize the following conversation between a user and a Lark Base task assistant in at most 200 words.
+Keep the record ids, task titles, due dates and statuses the user worked with, and any action still awaiting confirmation.
+Leave out greetings, tool output that was not acted on, and anything already resolved.
+Also list the topics discussed.
 """
-"lark-mcp": {
-      "command": "npx",
-      "args": [
-        "-y",
-        "@larksuiteoapi/lark-mcp",
-        "mcp",
-        "-a",
-        "cli_a7e3876125b95010",
-        "-s",
-        "bnR0sCHHILwnt15g8Lr0HgTIbk0ZVelI",
-        "-d",
-        "https://open.larksuite.com/",
-        "--oauth"
-      ]
-    },
 
-"""
-def lark_agent():
-    """Run AI Agent team."""
-    ## Declare MCP tools - Only Freepik (Mapbox removed due to timeout)
-    content_env = {
-            **os.environ,
-            'FREEPIK_API_KEY': os.getenv('FREEPIK_API_KEY'),
-    }
-
-    lark_mcp = MultiMCPTools(
-        commands=[
-            # f"npx -y mcp-remote https://api.freepik.com/mcp --header x-freepik-api-key:{os.getenv('FREEPIK_API_KEY')}",
-            f"npx -y @larksuiteoapi/lark-mcp mcp -a cli_a7e3876125b95010 -s bnR0sCHHILwnt15g8Lr0HgTIbk0ZVelI -d https://open.larksuite.com/ --oauth"
-        ],
-        # env=content_env,
+# xAI API client - one HTTP/2 keep-alive pool for every model call, closed with the app
+_XAI_HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(300.0, connect=5.0),
+    limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+)
+
+
+# One Grok model shared by every agent - it holds no per-run state, and its SDK client (built
+# on first use) then exists once
+_XAI = xAI(
+    id="grok-4-0709",
+    api_key=XAI_API_KEY,
+    http_client=_XAI_HTTP,
+)
+
+# Small model for session summaries - they are written after the reply, off the response path
+_XAI_SUMMARY = xAI(
+    id=os.getenv("XAI_SUMMARY_MODEL", "grok-3-mini"),
+    api_key=XAI_API_KEY,
+    http_client=_XAI_HTTP,
+)
+session_summary_manager = SessionSummaryManager(model=_XAI_SUMMARY, session_summary_prompt=SESSION_SUMMARY_PROMPT)
+summary_tasks = set()  # running summaries, referenced until done so they are not collected
+
+
+async def _summarize_session(agent, session, run_output):
+    """Fold the finished run into the stored session summary"""
+    try:
+        session.upsert_run(run=run_output)
+        summary = await session_summary_manager.acreate_session_summary(session=session)
+        if summary is None:
+            return
+        # The user's next turn may have saved the session while the summary was generated, so
+        # the summary goes onto the current row instead of writing this run's copy back over it
+        latest = agent.db.get_session(
+            session_id=session.session_id, session_type=SessionType.AGENT, user_id=session.user_id
+        ) or session
+        latest.upsert_run(run=run_output)
+        latest.summary = summary
+        await agent.asave_session(latest)
+    except Exception as e:
+        log_warning(f"Session summary not updated: {e}")
+
+
+async def schedule_session_summary(agent, session, run_output):
+    """Post-hook starting the summary update without holding back the reply"""
+    task = asyncio.create_task(_summarize_session(agent, session, run_output))
+    summary_tasks.add(task)
+    task.add_done_callback(summary_tasks.discard)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await _XAI_HTTP.aclose()
+
+
+# lark-mcp server argv, built once from the app credentials and spawned without a shell
+LARK_MCP_ARGS = [
+    "mcp",
+    "-a",
+    APP_ID,
+    "-s",
+    APP_SECRET,
+    "-d",
+    "https://open.larksuite.com/",
+    "--oauth",
+]
+# The Docker image installs lark-mcp globally; npx (which resolves the package first) is the
+# fallback for machines without it
+if shutil.which("lark-mcp"):
+    LARK_MCP_SERVER = StdioServerParameters(command="lark-mcp", args=LARK_MCP_ARGS)
+else:
+    LARK_MCP_SERVER = StdioServerParameters(command="npx", args=["-y", "@larksuiteoapi/lark-mcp", *LARK_MCP_ARGS])
+
+
+@lru_cache(maxsize=1)
+def _get_lark_mcp():
+    """Return the one Lark MCP toolkit shared by every agent.
+
+    AgentOS connects it in its app lifespan, so the lark-mcp server is spawned once at startup
+    and closed at shutdown instead of on the first tool call.
+    """
+    return MultiMCPTools(
+        # f"npx -y mcp-remote https://api.freepik.com/mcp --header x-freepik-api-key:{os.getenv('FREEPIK_API_KEY')}",
+        server_params_list=[LARK_MCP_SERVER],
         timeout_seconds=60,  # Increase timeout to 30 seconds
         allow_partial_failure=True  # Allow agent to run even if Freepik connection fails
     )
 
+
+def lark_agent():
+    """Run AI Agent team."""
+    lark_mcp = _get_lark_mcp()
+
     lark_base_agent = Agent(
         name = "Lark Task Management Agent",
         role = "Manage Lark Tasks within a Lark Base using Lark MCP",
-        model = xAI(
-        id="grok-4-0709",
-        api_key=os.getenv("XAI_API_KEY"),
-        ),
-        description="You are a task management assistant that helps users manage their tasks in Lark Base using Lark MCP. You can create, update, delete, and retrieve tasks based on user requests.",
-        instructions=[
-            "Use the Lark MCP tool to interact with Lark Base. The specific base id is 'Q9gVbS1j1anjh7sP56Dln1xFgdG'.",
-            "When creating or updating tasks, ensure to include all necessary fields such as title, description, due date, and status.",
-            "Always confirm actions with the user before making changes to their tasks.",
-            "Provide clear and concise responses to the user regarding their task management requests."
-        ],
+        model = _XAI,
+        description=LARK_AGENT_DESCRIPTION,
+        instructions=LARK_AGENT_INSTRUCTIONS,
         tools = [lark_mcp],
-        db = db,
+        tool_hooks = [cache_tool_results],
+        db = _get_db(),
+        add_session_summary_to_context=True, ## older turns reach the model as a short running summary,
+        ## written by schedule_session_summary after the reply - a summary manager on the agent
+        ## would make Agno write it inside the run
+        post_hooks=[schedule_session_summary],
         add_history_to_context=True,
         read_chat_history=True,
-        num_history_runs=2,
+        num_history_runs=1, ## last turn stays verbatim so "yes" can answer a pending confirmation
         search_session_history=True,
         markdown=True,
         debug_mode=False,  # Hide intermediate output - only team sees this
@@ -352,10 +510,7 @@ def lark_agent():
     # content_team = Team(
     #     name="AI SEO Content Team",
     #     role="Coordinate the team members to create a short story with images. Every story MUST include images.",
-    #     model = xAI(
-    #     id="grok-4-0709",
-    #     api_key=os.getenv("XAI_API_KEY"),
-    #     ),
+    #     model = _XAI,
     #     description="You coordinate a team to create illustrated short stories. Every story must have images embedded.",
     #     instructions=[
     #         "Step 1: Use outline agent to generate a story outline",
@@ -392,7 +547,10 @@ def lark_agent():
         description="My AgentOS",
         # agents=[assistant],
         # teams=[content_team],
-        agents=[lark_base_agent]
+        agents=[lark_base_agent],
+        lifespan=lifespan,
+        # Frontends allowed to call the API, merged by AgentOS with its own control-plane domains
+        cors_allowed_origins=CORS_ALLOWED_ORIGINS,
     )
 
     return agent_os
@@ -401,24 +559,42 @@ def lark_agent():
 os_instance = lark_agent()
 app = os_instance.get_app()
 
-# Add CORS middleware to allow frontend to connect
-from fastapi.middleware.cors import CORSMiddleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allow all origins for now - you can restrict this later
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+@app.get("/tool-cache/metrics")
+async def tool_cache_metrics():
+    """Hit/miss counters of the MCP tool result cache (/metrics belongs to AgentOS)"""
+    return {**tool_cache_stats, "entries": len(tool_cache)}
+
+
+# Everything built so far (agents, MCP toolkit, database, routes) lives for the whole process.
+# Move it out of the collector's generations so collections during requests only scan
+# request objects, and collect less often.
+gc.collect()
+gc.freeze()
+gc.set_threshold(100_000, 50, 50)
+
 
 if __name__ == "__main__":
     # Get port from environment variable (Railway) or default to 7778
     port = int(os.getenv("PORT", "7778"))
     host = os.getenv("HOST", "0.0.0.0")  # Listen on all interfaces for Docker/Railway
 
+    # uvloop is not available on Windows, fall back to the stock asyncio loop there
+    try:
+        import uvloop  # noqa: F401
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+
+    # One worker by default - each worker imports this module itself, so it gets its own database
+    # pool, lark-mcp server and tool cache, and a write handled by one worker would not clear the
+    # cached reads of another. Raise WEB_CONCURRENCY only with workers x pool within Supabase limits.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+
     os_instance.serve(
         app="agents:app",
         reload=False,
         port=port,
-        host=host
+        host=host,
+        loop=loop,
+        workers=workers
     )